@@ -0,0 +1,181 @@
+import math
+from collections import OrderedDict
+import numpy as np
+import discord
+
+# --- Constants ---
+FRAME_SIZE = 3840 # 20ms of 48kHz stereo int16 PCM, what discord.py reads per packet
+FRAMES_PER_SECOND = 50
+TARGET_RMS = 0.1 * 32768 # About -20 dBFS
+MIN_GAIN, MAX_GAIN = 0.25, 4.0
+# A first listen starts at unity gain: the first estimate comes after one second and is re-estimated every second,
+# eased in at GAIN_RAMP_DB per second. A much louder or quieter track therefore settles over its first few
+# seconds (about 3.5s for a 10 dB correction); every later play starts at the cached gain.
+MEASURE_FRAMES = FRAMES_PER_SECOND
+GAIN_RAMP_DB = 4
+GAIN_RAMP_PER_FRAME = 10 ** (GAIN_RAMP_DB / 20 / FRAMES_PER_SECOND)
+MIN_CACHED_SHARE = 0.5 # Part of a track that must have been heard before its loudness is cached
+MIN_CACHED_FRAMES = 60 * FRAMES_PER_SECOND # Stands in for that share when the duration is unknown
+PREFETCH_LEAD = 10 * FRAMES_PER_SECOND # How early, before the fade, to ask for the next track
+
+# video id -> RMS measured over most of a play; replayed tracks start at the right gain immediately
+LOUDNESS_CACHE = OrderedDict()
+LOUDNESS_CACHE_SIZE = 5000
+
+def remember_loudness(video_id, rms):
+    LOUDNESS_CACHE[video_id] = rms
+    LOUDNESS_CACHE.move_to_end(video_id)
+    if len(LOUDNESS_CACHE) > LOUDNESS_CACHE_SIZE:
+        LOUDNESS_CACHE.popitem(last=False)
+
+def loudness_gain(rms):
+    return min(MAX_GAIN, max(MIN_GAIN, TARGET_RMS / max(rms, 1.0)))
+
+class MixerTrack:
+    def __init__(self, source, song, video_id=None, duration=None, cached_stream=False):
+        self.source = source
+        self.song = song
+        self.video_id = video_id
+        self.cached_stream = cached_stream # Stream URL reused from an earlier resolution
+        self.ended = False
+        self.total_frames = int(duration * FRAMES_PER_SECOND) if duration else 0
+        self.frames_read = 0
+        self.sum_squares = 0.0
+        self.prefetch_requested = False
+        cached = LOUDNESS_CACHE.get(video_id) if video_id else None
+        self.measured = cached is not None
+        self.gain = self.target_gain = loudness_gain(cached) if self.measured else 1.0
+
+    @property
+    def remaining_frames(self):
+        return self.total_frames - self.frames_read if self.total_frames else None
+
+    def read(self):
+        # One normalized frame as float32 (960, 2), or None once the source is exhausted.
+        data = self.source.read()
+        if len(data) != FRAME_SIZE:
+            self.ended = True
+            self.finish()
+            return None
+        frame = np.frombuffer(data, dtype=np.int16).astype(np.float32).reshape(-1, 2)
+        self.frames_read += 1
+        if not self.measured:
+            self.sum_squares += float(np.dot(frame.ravel(), frame.ravel()))
+            if self.frames_read >= MEASURE_FRAMES and self.frames_read % FRAMES_PER_SECOND == 0:
+                self.target_gain = loudness_gain(self.rms())
+        # Ramp towards the target across the frame so on-the-fly gain changes don't click.
+        if self.gain != self.target_gain:
+            ratio = self.target_gain / self.gain
+            if ratio > GAIN_RAMP_PER_FRAME: new_gain = self.gain * GAIN_RAMP_PER_FRAME
+            elif ratio < 1 / GAIN_RAMP_PER_FRAME: new_gain = self.gain / GAIN_RAMP_PER_FRAME
+            else: new_gain = self.target_gain
+            ramp = np.linspace(self.gain, new_gain, len(frame), dtype=np.float32)[:, None]
+            self.gain = new_gain
+            return frame * ramp
+        return frame * self.gain
+
+    def rms(self):
+        return math.sqrt(self.sum_squares / max(1, self.frames_read * FRAME_SIZE // 2))
+
+    @property
+    def produced_nothing(self):
+        # Ran out without a single frame, e.g. ffmpeg got a 403 for a revoked stream URL.
+        return self.ended and self.frames_read == 0
+
+    def finish(self):
+        # Cache the loudness once enough of the track was heard, including a play cut short by a crossfade;
+        # a skip a few seconds in would only measure the intro.
+        required = self.total_frames * MIN_CACHED_SHARE if self.total_frames else MIN_CACHED_FRAMES
+        if not self.measured and self.video_id and self.frames_read >= max(MEASURE_FRAMES, required):
+            remember_loudness(self.video_id, self.rms())
+            self.measured = True
+
+    def cleanup(self):
+        self.source.cleanup()
+
+class CrossfadeMixer(discord.AudioSource):
+    # Plays a track and equal-power crossfades into a prefetched next one; the voice client's
+    # after callback only fires once a track ends with nothing lined up behind it.
+    def __init__(self, track, volume=0.5, crossfade=0, on_need_next=None, on_track_change=None):
+        self.current = track
+        self.incoming = None
+        self.volume = volume
+        self.fade_frames = int(crossfade * FRAMES_PER_SECOND)
+        self.fade_position = 0
+        self.pending_fade_frames = None
+        self.on_need_next = on_need_next
+        self.on_track_change = on_track_change
+        self.closed = False
+
+    def queue_next(self, track):
+        # Called from the event loop once the next song is resolved; late arrivals are dropped.
+        if self.closed or self.incoming is not None:
+            track.cleanup()
+        else:
+            self.incoming = track
+
+    def set_crossfade(self, seconds):
+        # Applied by read() between fades, so a transition already underway keeps its curve.
+        self.pending_fade_frames = int(seconds * FRAMES_PER_SECOND)
+
+    def is_opus(self):
+        return False
+
+    def read(self):
+        if self.pending_fade_frames is not None and not self.fade_position:
+            self.fade_frames, self.pending_fade_frames = self.pending_fade_frames, None
+        current = self.current
+        remaining = current.remaining_frames
+        if remaining is not None and not current.prefetch_requested and remaining <= self.fade_frames + PREFETCH_LEAD:
+            current.prefetch_requested = True
+            if self.on_need_next: self.on_need_next(self)
+
+        frame = current.read()
+        if self.incoming is None:
+            return self._encode(frame * self.volume) if frame is not None else b''
+        if self.fade_position or (frame is not None and self.fade_frames and remaining is not None and remaining <= self.fade_frames):
+            frame = self._mix(frame)
+        elif frame is None:
+            # No fade in progress: switch straight over, gaplessly.
+            self._advance()
+            frame = self.current.read()
+        return self._encode(frame * self.volume) if frame is not None else b''
+
+    def _mix(self, outgoing):
+        # outgoing is None once the current track has ended early; the incoming one still finishes its ramp.
+        incoming = self.incoming.read()
+        if incoming is None:
+            # The next track ended during the fade; let the current one finish on its own.
+            self.incoming.cleanup()
+            self.incoming = None
+            self.fade_position = 0
+            return outgoing
+        start = self.fade_position / self.fade_frames
+        self.fade_position += 1
+        end = min(1.0, self.fade_position / self.fade_frames)
+        angles = np.linspace(start, end, len(incoming), dtype=np.float32)[:, None] * (math.pi / 2)
+        mixed = incoming * np.sin(angles)
+        if outgoing is not None:
+            mixed += outgoing * np.cos(angles)
+        if self.fade_position >= self.fade_frames:
+            # Fade complete: drop the rest of the outgoing track even if it runs past its stated duration.
+            self._advance()
+        return mixed
+
+    def _advance(self):
+        self.current.finish()
+        self.current.cleanup()
+        self.current, self.incoming = self.incoming, None
+        self.fade_position = 0
+        if self.on_track_change: self.on_track_change(self.current)
+
+    @staticmethod
+    def _encode(frame):
+        return np.clip(frame, -32768, 32767).astype(np.int16).tobytes()
+
+    def cleanup(self):
+        self.closed = True
+        self.current.cleanup()
+        if self.incoming is not None:
+            self.incoming.cleanup()
+            self.incoming = None
@@ -1,16 +1,22 @@
 import os
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord import app_commands
 from dotenv import load_dotenv
 import yt_dlp
-from collections import deque
+from yt_dlp.networking.exceptions import HTTPError as YtdlpHTTPError, TransportError
+from collections import deque, OrderedDict
 import asyncio
 import random
+import heapq
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
 import time
 import logging
+from mixer import CrossfadeMixer, MixerTrack
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
 
 # --- Environment and Logging Setup ---
 load_dotenv()
@@ -26,9 +32,59 @@ logging.basicConfig(level=logging.INFO,
                     ])
 
 # --- Global State & Theme Colors ---
-SONG_QUEUES = {}
-NOW_PLAYING_MESSAGES = {}
-GUILD_VOLUMES = {}
+MAX_QUEUE_LENGTH = 500
+GUILD_IDLE_TTL = 30 * 60 # Seconds without activity before an unconnected guild's state is dropped
+DEFAULT_CROSSFADE = 4 # Seconds
+
+class GuildState:
+    __slots__ = ("queue", "volume", "crossfade", "now_playing", "last_active")
+
+    def __init__(self):
+        self.queue = deque()
+        self.volume = 0.5 # Default to 50%
+        self.crossfade = DEFAULT_CROSSFADE
+        self.now_playing = None
+        self.last_active = time.monotonic()
+
+class GuildRegistry:
+    # Single home for per-guild queues, volumes and "Now Playing" messages, keyed by integer guild id.
+    def __init__(self, idle_ttl=GUILD_IDLE_TTL, max_queue_length=MAX_QUEUE_LENGTH):
+        self.idle_ttl = idle_ttl
+        self.max_queue_length = max_queue_length
+        self.guilds = {}
+
+    def get(self, guild_id):
+        return self.guilds.get(guild_id)
+
+    def touch(self, guild_id):
+        state = self.guilds.get(guild_id)
+        if state is None:
+            state = self.guilds[guild_id] = GuildState()
+        state.last_active = time.monotonic()
+        return state
+
+    def evict(self, guild_id):
+        return self.guilds.pop(guild_id, None)
+
+    def evict_idle(self, is_active=lambda guild_id: False):
+        cutoff = time.monotonic() - self.idle_ttl
+        idle = [gid for gid, state in self.guilds.items() if state.last_active < cutoff and not is_active(gid)]
+        for guild_id in idle:
+            del self.guilds[guild_id]
+        return len(idle)
+
+    def memory_usage(self):
+        # Rough deep size of everything the registry owns; message handles are counted shallowly.
+        total = sys.getsizeof(self.guilds)
+        songs = 0
+        for state in self.guilds.values():
+            total += sys.getsizeof(state) + sys.getsizeof(state.queue)
+            songs += len(state.queue)
+            for song in state.queue:
+                total += sys.getsizeof(song) + sum(sys.getsizeof(value) for value in song.values())
+        return {"guilds": len(self.guilds), "queued_songs": songs, "bytes": total}
+
+GUILD_STATES = GuildRegistry()
 THEME_COLOR_BLUE = discord.Color.from_rgb(52, 152, 219) # A nice shade of blue
 THEME_COLOR_YELLOW = discord.Color.from_rgb(241, 196, 15) # A vibrant yellow
 
@@ -39,10 +95,184 @@ else:
     spotify = None
     print("Spotify credentials not found. Spotify integration will be disabled.")
 
-async def search_ytdlp_async(query, ydl_opts):
-    loop = asyncio.get_running_loop()
+# --- Extraction Deadlines, Hedging & Circuit Breaker ---
+EXTRACT_TIMEOUT = 20 # Seconds before a /play lookup gives up
+HEDGE_DELAY = 4 # Seconds before a second, differently configured attempt is raced against the first
+# Clients that still accept cookies.txt but aren't among yt-dlp's defaults, so the hedge really takes another
+# route. Flat ytsearch lookups never load a player, so for /play searches the hedge is a plain retry.
+HEDGE_OPTS = {"extractor_args": {"youtube": {"player_client": ["mweb", "web_safari"]}}}
+# Stream resolution also asks for a different format, so a broken format or CDN node isn't hit twice.
+STREAM_HEDGE_OPTS = {**HEDGE_OPTS, "format": "bestaudio[ext=m4a]/bestaudio/best"}
+# Dedicated pool so hung extractions can't starve the loop's default executor; threads can't be killed,
+# so socket_timeout is what eventually frees them.
+YTDLP_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="ytdlp")
+
+class ExtractionError(Exception):
+    pass
+
+class CircuitOpenError(ExtractionError):
+    def __init__(self, domain, retry_after):
+        super().__init__(f"{domain} is failing; backing off for another {retry_after:.0f}s.")
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    # Opens per domain after repeated failures, with exponential backoff between half-open retries.
+    def __init__(self, threshold=5, base_backoff=5, max_backoff=300):
+        self.threshold = threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.domains = {} # domain -> [consecutive failures, open until, times tripped]
+
+    def check(self, domain):
+        state = self.domains.get(domain)
+        if state and state[1] > time.monotonic():
+            raise CircuitOpenError(domain, state[1] - time.monotonic())
+
+    def success(self, domain):
+        self.domains.pop(domain, None)
+
+    def failure(self, domain):
+        state = self.domains.setdefault(domain, [0, 0.0, 0])
+        state[0] += 1
+        if state[0] >= self.threshold:
+            state[1] = time.monotonic() + min(self.max_backoff, self.base_backoff * 2 ** state[2])
+            state[2] += 1
+            logging.warning(f"Extraction circuit opened for {domain} (trip {state[2]}).")
+
+EXTRACT_BREAKER = CircuitBreaker()
+
+def _extract(query, ydl_opts):
     with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        return await loop.run_in_executor(None, lambda: ydl.extract_info(query, download=False))
+        return ydl.extract_info(query, download=False)
+
+def _is_transient(error):
+    # Follow yt-dlp's wrappers (DownloadError -> ExtractorError -> cause) down to a network error, if any.
+    # Anything else, like an unavailable or private video, fails the same way on every attempt.
+    for _ in range(5):
+        if isinstance(error, YtdlpHTTPError):
+            return error.status == 429 or error.status >= 500
+        if isinstance(error, (TransportError, TimeoutError, ConnectionError)):
+            return True
+        error = getattr(error, "cause", None) or (getattr(error, "exc_info", None) or (None, None))[1] or error.__cause__
+        if error is None: return False
+    return False
+
+def _extract_domain(query):
+    if "://" not in query:
+        return "youtube.com" # ytsearch queries
+    domain = urlparse(query).netloc.lower().removeprefix("www.").removeprefix("m.").removeprefix("music.")
+    return "youtube.com" if domain == "youtu.be" else domain
+
+async def search_ytdlp_async(query, ydl_opts, timeout=EXTRACT_TIMEOUT, hedge_opts=HEDGE_OPTS):
+    domain = _extract_domain(query)
+    EXTRACT_BREAKER.check(domain)
+    loop = asyncio.get_running_loop()
+    opts = {"socket_timeout": 10, **ydl_opts}
+    deadline = loop.time() + timeout
+    hedge_at = loop.time() + HEDGE_DELAY if hedge_opts is not None else None
+    pending = {loop.run_in_executor(YTDLP_EXECUTOR, _extract, query, opts)}
+    error = None
+    while pending and loop.time() < deadline:
+        wake = deadline if hedge_at is None else min(deadline, hedge_at)
+        done, pending = await asyncio.wait(pending, timeout=wake - loop.time(), return_when=asyncio.FIRST_COMPLETED)
+        for attempt in done:
+            if attempt.exception() is None:
+                for other in pending: other.cancel()
+                EXTRACT_BREAKER.success(domain)
+                return attempt.result()
+            error = attempt.exception()
+            if not _is_transient(error):
+                for other in pending: other.cancel()
+                raise error
+        # Hedge once the first attempt is slow, or retry straight away if it already failed.
+        if hedge_at is not None and (loop.time() >= hedge_at or not pending):
+            pending.add(loop.run_in_executor(YTDLP_EXECUTOR, _extract, query, {**opts, **hedge_opts}))
+            hedge_at = None
+    for attempt in pending: attempt.cancel()
+    EXTRACT_BREAKER.failure(domain)
+    if pending or error is None:
+        raise ExtractionError(f"Timed out after {timeout}s.")
+    raise error
+
+# --- Stream Probe Cache ---
+PROBE_CACHE_SIZE = 2000
+STREAM_URL_TTL = 3600 # Used when a stream URL carries no expire= parameter
+FFMPEG_BEFORE_OPTIONS = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+# yt-dlp container -> ffmpeg demuxer. With the demuxer named up front ffmpeg doesn't have to sniff the stream,
+# and since these containers carry the codec parameters in their header it can skip most stream analysis too.
+FFMPEG_DEMUXERS = {"webm": "matroska", "m4a": "mov", "mp4": "mov", "mp3": "mp3", "ogg": "ogg"}
+FFMPEG_FAST_START = "-probesize 32768 -analyzeduration 0"
+
+class ProbeInfo:
+    __slots__ = ("video_id", "format_id", "container", "protocol", "codec", "sample_rate", "bitrate", "duration", "url", "expires")
+
+    def __init__(self, info):
+        self.video_id = info.get("id")
+        self.format_id = info.get("format_id")
+        self.container = info.get("ext")
+        self.protocol = info.get("protocol")
+        self.codec = info.get("acodec")
+        self.sample_rate = info.get("asr")
+        self.bitrate = info.get("abr") or info.get("tbr")
+        self.duration = info.get("duration")
+        self.url = info.get("url")
+        expire = parse_qs(urlparse(self.url or "").query).get("expire")
+        self.expires = int(expire[0]) if expire and expire[0].isdigit() else time.time() + STREAM_URL_TTL
+
+    def is_fresh(self):
+        return self.url is not None and self.expires - 60 > time.time()
+
+    def ffmpeg_input_options(self):
+        # Only plain progressive downloads of a known audio container; HLS/DASH manifests keep ffmpeg's probing.
+        demuxer = FFMPEG_DEMUXERS.get(self.container)
+        if demuxer is None or self.protocol not in ("http", "https") or self.codec in (None, "none"):
+            return ""
+        return f"-f {demuxer} {FFMPEG_FAST_START}"
+
+class ProbeCache:
+    # What yt-dlp resolved for each (video id, format id), so a repeat track start needs no extraction
+    # and ffmpeg can skip most of its own input probing.
+    def __init__(self, max_entries=PROBE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # (video id, format id) -> ProbeInfo
+        self.formats = {}            # video id -> format id last chosen by "bestaudio"
+
+    def store(self, info):
+        probe = ProbeInfo(info)
+        if probe.video_id is None or probe.format_id is None:
+            return probe
+        key = (probe.video_id, probe.format_id)
+        self.entries[key] = probe
+        self.entries.move_to_end(key)
+        self.formats[probe.video_id] = probe.format_id
+        if len(self.entries) > self.max_entries:
+            (old_id, old_format), _ = self.entries.popitem(last=False)
+            if self.formats.get(old_id) == old_format: del self.formats[old_id]
+        return probe
+
+    def lookup(self, video_id, format_id=None):
+        format_id = format_id or self.formats.get(video_id)
+        probe = self.entries.get((video_id, format_id))
+        if probe: self.entries.move_to_end((video_id, format_id))
+        return probe
+
+    def invalidate(self, video_id):
+        format_id = self.formats.pop(video_id, None)
+        return self.entries.pop((video_id, format_id), None)
+
+    def duration(self, video_id):
+        probe = self.lookup(video_id)
+        return probe.duration if probe else None
+
+PROBE_CACHE = ProbeCache()
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}" if hours else f"{minutes}:{seconds:02}"
+
+def song_duration(song):
+    return song.get('duration') or PROBE_CACHE.duration(song.get('video_id'))
 
 def get_spotify_tracks(query):
     if not spotify or "spotify.com" not in query:
@@ -68,6 +298,98 @@ def get_spotify_tracks(query):
         return []
     return songs
 
+# --- Play History & Autocomplete ---
+HISTORY_HALF_LIFE = 7 * 24 * 3600 # A play counts half as much after a week
+HISTORY_PREFIX_LEN = 3
+
+class TitleIndex:
+    # Bounded word-prefix index of played titles, ranked by an exponentially decayed play count.
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # normalized title -> [title, score, last_played]
+        self.prefixes = {}           # word prefix -> set of normalized titles
+
+    @staticmethod
+    def _words(text):
+        return text.casefold().split()
+
+    @staticmethod
+    def _decayed(score, last_played, now):
+        return score * 0.5 ** ((now - last_played) / HISTORY_HALF_LIFE)
+
+    def _prefix_keys(self, key):
+        return {word[:n] for word in key.split() for n in range(1, min(len(word), HISTORY_PREFIX_LEN) + 1)}
+
+    def record(self, title, now):
+        key = " ".join(self._words(title))
+        if not key: return
+        entry = self.entries.get(key)
+        if entry:
+            entry[0], entry[1], entry[2] = title, self._decayed(entry[1], entry[2], now) + 1.0, now
+            self.entries.move_to_end(key)
+            return
+        self.entries[key] = [title, 1.0, now]
+        for prefix in self._prefix_keys(key):
+            self.prefixes.setdefault(prefix, set()).add(key)
+        if len(self.entries) > self.max_entries:
+            self._evict()
+
+    def _evict(self):
+        old_key, _ = self.entries.popitem(last=False)
+        for prefix in self._prefix_keys(old_key):
+            keys = self.prefixes.get(prefix)
+            if keys is None: continue
+            keys.discard(old_key)
+            if not keys: del self.prefixes[prefix]
+
+    def search(self, query, now, limit):
+        words = self._words(query)
+        if not words:
+            candidates = self.entries.keys()
+        else:
+            buckets = [self.prefixes.get(word[:HISTORY_PREFIX_LEN], set()) for word in words]
+            candidates = set.intersection(*buckets)
+            if any(len(word) > HISTORY_PREFIX_LEN for word in words):
+                candidates = [key for key in candidates
+                              if all(any(t.startswith(word) for t in key.split()) for word in words)]
+        scored = [(self._decayed(self.entries[key][1], self.entries[key][2], now), key) for key in candidates]
+        return [(score, self.entries[key][0]) for score, key in heapq.nlargest(limit, scored)]
+
+class PlayHistory:
+    # Per-guild and global title indexes; the least recently active guilds are dropped first.
+    def __init__(self, per_guild=200, global_entries=2000, max_guilds=500):
+        self.per_guild = per_guild
+        self.max_guilds = max_guilds
+        self.global_index = TitleIndex(global_entries)
+        self.guild_indexes = OrderedDict()
+
+    def record(self, guild_id, title):
+        now = time.time()
+        index = self.guild_indexes.get(guild_id)
+        if index is None:
+            index = self.guild_indexes[guild_id] = TitleIndex(self.per_guild)
+            if len(self.guild_indexes) > self.max_guilds:
+                self.guild_indexes.popitem(last=False)
+        self.guild_indexes.move_to_end(guild_id)
+        index.record(title, now)
+        self.global_index.record(title, now)
+
+    def suggest(self, guild_id, query, limit=25):
+        now = time.time()
+        suggestions = []
+        index = self.guild_indexes.get(guild_id)
+        if index:
+            suggestions = [title for _, title in index.search(query, now, limit)]
+        if len(suggestions) < limit:
+            seen = {title.casefold() for title in suggestions}
+            for _, title in self.global_index.search(query, now, limit):
+                if title.casefold() not in seen:
+                    suggestions.append(title)
+                    if len(suggestions) == limit: break
+        return suggestions
+
+PLAY_HISTORY = PlayHistory()
+
 # --- UI Modals and Views ---
 class VolumeModal(discord.ui.Modal, title="Set Volume"):
     volume_input = discord.ui.TextInput(label="Volume Level (1-100)", placeholder="e.g., 50 for 50% volume", min_length=1, max_length=3)
@@ -81,7 +403,7 @@ class VolumeModal(discord.ui.Modal, title="Set Volume"):
             if not 1 <= new_volume <= 100:
                 raise ValueError()
             voice_client.source.volume = new_volume / 100.0
-            GUILD_VOLUMES[str(interaction.guild_id)] = new_volume / 100.0
+            GUILD_STATES.touch(interaction.guild_id).volume = new_volume / 100.0
             await interaction.response.send_message(f"🔊 Volume set to **{new_volume}%**.", ephemeral=True)
         except (ValueError, TypeError):
             await interaction.response.send_message("Invalid input. Please enter a number between 1 and 100.", ephemeral=True)
@@ -115,20 +437,18 @@ class MusicControls(discord.ui.View):
     @discord.ui.button(label="⏹ Stop", style=discord.ButtonStyle.danger, custom_id="stop", row=0)
     async def stop(self, interaction: discord.Interaction, button: discord.ui.Button):
         voice_client = interaction.guild.voice_client
-        guild_id = str(interaction.guild_id)
-        if guild_id in SONG_QUEUES: SONG_QUEUES[guild_id].clear()
+        state = GUILD_STATES.get(interaction.guild_id)
+        if state: state.queue.clear()
         if voice_client and voice_client.is_connected():
             voice_client.stop()
             await voice_client.disconnect()
             await interaction.response.send_message("Stopped and left the channel.", ephemeral=True)
-            if guild_id in NOW_PLAYING_MESSAGES and NOW_PLAYING_MESSAGES[guild_id]:
-                try: await NOW_PLAYING_MESSAGES[guild_id].delete()
-                except discord.NotFound: pass
-                NOW_PLAYING_MESSAGES[guild_id] = None
+            if state: await clear_now_playing(state)
 
     @discord.ui.button(label="🔀 Shuffle", style=discord.ButtonStyle.primary, custom_id="shuffle", row=1)
     async def shuffle(self, interaction: discord.Interaction, button: discord.ui.Button):
-        queue = SONG_QUEUES.get(str(interaction.guild_id))
+        state = GUILD_STATES.get(interaction.guild_id)
+        queue = state.queue if state else None
         if queue and len(queue) > 1:
             random.shuffle(queue)
             await interaction.response.send_message("Queue shuffled!", ephemeral=True)
@@ -137,14 +457,18 @@ class MusicControls(discord.ui.View):
 
     @discord.ui.button(label="📜 Queue", style=discord.ButtonStyle.secondary, custom_id="queue", row=1)
     async def queue(self, interaction: discord.Interaction, button: discord.ui.Button):
-        queue = SONG_QUEUES.get(str(interaction.guild_id))
+        state = GUILD_STATES.get(interaction.guild_id)
+        queue = state.queue if state else None
         if not queue:
             return await interaction.response.send_message("The queue is empty.", ephemeral=True)
         embed = discord.Embed(title="🎶 Song Queue", color=THEME_COLOR_BLUE)
         for i, song in enumerate(list(queue)[:10]):
-            embed.add_field(name=f"{i+1}. {song['title']}", value="", inline=False)
-        if len(queue) > 10:
-            embed.set_footer(text=f"...and {len(queue)-10} more.")
+            duration = song_duration(song)
+            embed.add_field(name=f"{i+1}. {song['title']}", value=format_duration(duration) if duration else "", inline=False)
+        footer = f"...and {len(queue)-10} more. " if len(queue) > 10 else ""
+        total = sum(song_duration(song) or 0 for song in queue)
+        if total: footer += f"Total length: {format_duration(total)}"
+        if footer: embed.set_footer(text=footer)
         await interaction.response.send_message(embed=embed, ephemeral=True)
 
     @discord.ui.button(label="🔊 Volume", style=discord.ButtonStyle.secondary, custom_id="volume", row=1)
@@ -155,9 +479,25 @@ intents = discord.Intents.default()
 intents.message_content = True
 bot = commands.Bot(command_prefix="!", intents=intents)
 
+async def clear_now_playing(state):
+    if state.now_playing:
+        try: await state.now_playing.delete()
+        except discord.NotFound: pass
+        state.now_playing = None
+
+@tasks.loop(minutes=5)
+async def evict_idle_guilds():
+    def is_active(guild_id):
+        guild = bot.get_guild(guild_id)
+        return bool(guild and guild.voice_client and guild.voice_client.is_connected())
+    evicted = GUILD_STATES.evict_idle(is_active)
+    usage = GUILD_STATES.memory_usage()
+    logging.info(f"Guild state: evicted {evicted} idle, {usage['guilds']} guilds, {usage['queued_songs']} queued songs, ~{usage['bytes'] // 1024} KiB.")
+
 @bot.event
 async def on_ready():
     bot.add_view(MusicControls(bot))
+    if not evict_idle_guilds.is_running(): evict_idle_guilds.start()
     await bot.tree.sync()
     print(f"{bot.user} is online!")
 
@@ -176,8 +516,10 @@ async def join_command(interaction: discord.Interaction):
 async def leave_command(interaction: discord.Interaction):
     voice_client = interaction.guild.voice_client
     if voice_client:
+        # Evict first: disconnecting stops the player, and its after callback must find no queue to resume.
+        state = GUILD_STATES.evict(interaction.guild_id)
+        if state: await clear_now_playing(state)
         await voice_client.disconnect()
-        SONG_QUEUES.pop(str(interaction.guild_id), None)
         await interaction.response.send_message(embed=discord.Embed(title="👋 Disconnected", color=THEME_COLOR_YELLOW))
     else:
         await interaction.response.send_message(embed=discord.Embed(title="❌ Not Connected", description="I'm not in a voice channel.", color=discord.Color.red()), ephemeral=True)
@@ -195,11 +537,15 @@ async def play_command(interaction: discord.Interaction, song_query: str):
     elif voice_client.channel != voice_channel: await voice_client.move_to(voice_channel)
 
     song_queries = get_spotify_tracks(song_query) or [song_query]
-    guild_id = str(interaction.guild_id)
-    if guild_id not in SONG_QUEUES: SONG_QUEUES[guild_id] = deque()
+    guild_id = interaction.guild_id
+    state = GUILD_STATES.touch(guild_id)
 
     added_to_queue = []
+    notice = None # Why the loop stopped early, sent once instead of per query
     for query in song_queries:
+        if len(state.queue) >= GUILD_STATES.max_queue_length:
+            notice = discord.Embed(title="⚠️ Queue Full", description=f"The queue is capped at **{GUILD_STATES.max_queue_length}** songs.", color=discord.Color.orange())
+            break
         try:
             ydl_opts = {"format": "bestaudio", "noplaylist": True, "quiet": True, "extract_flat": True, "cookiefile": "cookies.txt"}
             results = await search_ytdlp_async(f"ytsearch1:{query}", ydl_opts)
@@ -207,11 +553,19 @@ async def play_command(interaction: discord.Interaction, song_query: str):
             video_info = results['entries'][0]
             title = video_info.get("title", "Untitled")
             webpage_url = video_info.get("url")
-            SONG_QUEUES[guild_id].append({'webpage_url': webpage_url, 'title': title})
+            state.queue.append({'webpage_url': webpage_url, 'title': title, 'video_id': video_info.get("id"), 'duration': video_info.get("duration")})
             added_to_queue.append(title)
+            PLAY_HISTORY.record(guild_id, title)
+        except CircuitOpenError as e:
+            # Every remaining query would be rejected the same way.
+            notice = discord.Embed(title="⏳ Search Unavailable", description=f"Searches are failing right now. Try again in {e.retry_after:.0f}s.", color=discord.Color.orange())
+            break
         except Exception as e:
             await interaction.channel.send(embed=discord.Embed(title="❌ Fetch Error", description=f"Could not fetch '{query}'.\n`{e}`", color=discord.Color.red()))
 
+    if notice:
+        if not added_to_queue: return await interaction.followup.send(embed=notice)
+        await interaction.channel.send(embed=notice)
     if not added_to_queue:
         return await interaction.followup.send(embed=discord.Embed(title="❌ No Results", description="Could not find any playable songs.", color=discord.Color.red()))
 
@@ -223,27 +577,79 @@ async def play_command(interaction: discord.Interaction, song_query: str):
         await interaction.followup.send(embed=discord.Embed(title="🎵 Let's begin!", description=f"Queued up **{first_song_title}**.", color=THEME_COLOR_YELLOW))
         await play_next_song(voice_client, guild_id, interaction.channel)
 
+@play_command.autocomplete("song_query")
+async def play_autocomplete(interaction: discord.Interaction, current: str):
+    # Served purely from memory so it stays well inside Discord's 3 second autocomplete window.
+    titles = PLAY_HISTORY.suggest(interaction.guild_id, current)
+    return [app_commands.Choice(name=title[:100], value=title[:100]) for title in titles]
+
+async def resolve_track(song_data):
+    probe = PROBE_CACHE.lookup(song_data.get('video_id'))
+    cached = probe is not None and probe.is_fresh()
+    if not cached:
+        stream_opts = {"format": "bestaudio", "quiet": True, "cookiefile": "cookies.txt"}
+        probe = PROBE_CACHE.store(await search_ytdlp_async(song_data['webpage_url'], stream_opts, hedge_opts=STREAM_HEDGE_OPTS))
+    before_options = f"{FFMPEG_BEFORE_OPTIONS} {probe.ffmpeg_input_options()}".rstrip()
+    source = discord.FFmpegPCMAudio(probe.url, before_options=before_options, options="-vn")
+    return MixerTrack(source, song_data, probe.video_id, probe.duration or song_data.get('duration'), cached_stream=cached)
+
+async def announce_now_playing(state, channel, title):
+    await clear_now_playing(state)
+    embed = discord.Embed(title="🎶 Now Playing", description=f"**{title}**", color=THEME_COLOR_YELLOW)
+    state.now_playing = await channel.send(embed=embed, view=MusicControls(bot))
+
+async def prefetch_next_song(mixer, state):
+    # Peek rather than pop: if the mixer is skipped or stopped first, the song simply stays queued.
+    if not state.queue: return
+    song_data = state.queue[0]
+    try:
+        mixer.queue_next(await resolve_track(song_data))
+    except Exception as e:
+        logging.warning(f"Could not prefetch '{song_data['title']}': {e}")
+
+async def on_track_change(state, channel, track):
+    try: state.queue.remove(track.song)
+    except ValueError: pass
+    state.last_active = time.monotonic()
+    await announce_now_playing(state, channel, track.song['title'])
+
+async def after_playback(voice_client, guild_id, channel, mixer):
+    track = mixer.current
+    state = GUILD_STATES.get(guild_id)
+    if state is not None and track.produced_nothing:
+        # The stream URL is dead (revoked or bound to another IP): forget it, and if it came from the
+        # cache give the song one more go with a fresh extraction instead of silently skipping it.
+        PROBE_CACHE.invalidate(track.video_id)
+        if track.cached_stream:
+            state.queue.appendleft(track.song)
+    await play_next_song(voice_client, guild_id, channel)
+
 async def play_next_song(voice_client, guild_id, channel):
-    if guild_id in NOW_PLAYING_MESSAGES and NOW_PLAYING_MESSAGES[guild_id]:
-        try: await NOW_PLAYING_MESSAGES[guild_id].delete()
-        except discord.NotFound: pass
-    
-    if guild_id in SONG_QUEUES and SONG_QUEUES[guild_id]:
-        song_data = SONG_QUEUES[guild_id].popleft()
-        title, webpage_url = song_data['title'], song_data['webpage_url']
+    state = GUILD_STATES.get(guild_id)
+    if state is None: return # Evicted by /leave
+    await clear_now_playing(state)
+
+    if state.queue:
+        state.last_active = time.monotonic()
+        song_data = state.queue.popleft()
+        title = song_data['title']
         try:
-            stream_opts = {"format": "bestaudio", "quiet": True, "cookiefile": "cookies.txt"}
-            stream_results = await search_ytdlp_async(webpage_url, stream_opts)
-            audio_url = stream_results['url']
-            ffmpeg_options = {"before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5", "options": "-vn"}
-            
-            guild_volume = GUILD_VOLUMES.get(guild_id, 0.5) # Default to 50%
-            source = discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(audio_url, **ffmpeg_options), volume=guild_volume)
-            
-            voice_client.play(source, after=lambda e: asyncio.run_coroutine_threadsafe(play_next_song(voice_client, guild_id, channel), bot.loop))
-            
-            embed = discord.Embed(title="🎶 Now Playing", description=f"**{title}**", color=THEME_COLOR_YELLOW)
-            NOW_PLAYING_MESSAGES[guild_id] = await channel.send(embed=embed, view=MusicControls(bot))
+            track = await resolve_track(song_data)
+            # The mixer reads on the voice thread, so its callbacks hop back onto the event loop.
+            source = CrossfadeMixer(track, volume=state.volume, crossfade=state.crossfade,
+                                    on_need_next=lambda mixer: asyncio.run_coroutine_threadsafe(prefetch_next_song(mixer, state), bot.loop),
+                                    on_track_change=lambda track: asyncio.run_coroutine_threadsafe(on_track_change(state, channel, track), bot.loop))
+
+            voice_client.play(source, after=lambda e: asyncio.run_coroutine_threadsafe(after_playback(voice_client, guild_id, channel, source), bot.loop))
+
+            await announce_now_playing(state, channel, title)
+        except CircuitOpenError as e:
+            # Every song would fail the same way, so keep this one and wait out the backoff instead of skipping.
+            state.queue.appendleft(song_data)
+            await channel.send(embed=discord.Embed(title="⏳ Playback Delayed", description=f"Couldn't reach the source for **{title}**. Retrying in {e.retry_after:.0f}s.", color=discord.Color.orange()))
+            await asyncio.sleep(e.retry_after)
+            if GUILD_STATES.get(guild_id) is state and voice_client.is_connected() and not (voice_client.is_playing() or voice_client.is_paused()):
+                await play_next_song(voice_client, guild_id, channel)
         except Exception as e:
             await channel.send(embed=discord.Embed(title="❌ Playback Error", description=f"Could not play '{title}'. Skipping.\n`{e}`", color=discord.Color.red()))
             await play_next_song(voice_client, guild_id, channel)
@@ -251,7 +657,19 @@ async def play_next_song(voice_client, guild_id, channel):
         await asyncio.sleep(180)
         if voice_client.is_connected() and not voice_client.is_playing():
             await voice_client.disconnect()
-            NOW_PLAYING_MESSAGES.pop(guild_id, None)
+            GUILD_STATES.evict(guild_id)
+
+@bot.tree.command(name="crossfade", description="Set the crossfade between songs (0 to turn it off)")
+@app_commands.describe(seconds="Crossfade length in seconds")
+async def crossfade_command(interaction: discord.Interaction, seconds: app_commands.Range[int, 0, 12]):
+    GUILD_STATES.touch(interaction.guild_id).crossfade = seconds
+    voice_client = interaction.guild.voice_client
+    source = voice_client.source if voice_client else None
+    fading = isinstance(source, CrossfadeMixer) and source.fade_position > 0
+    if isinstance(source, CrossfadeMixer): source.set_crossfade(seconds)
+    desc = "Crossfade turned off." if seconds == 0 else f"Songs will now blend over **{seconds}s**."
+    if fading: desc += " The blend already in progress finishes first."
+    await interaction.response.send_message(embed=discord.Embed(title="🎚️ Crossfade", description=desc, color=THEME_COLOR_BLUE), ephemeral=True)
 
 
 @bot.tree.command(name="ping", description="Check the bot's latency.")